@@ -29,30 +29,167 @@ SOFTWARE.
 
 __version__ = '0.5.1'
 
-import scipy.special
-import scipy.stats
+import functools
+import math
+
+from scipy.special import ndtri as _ndtri, ndtr as _ndtr, pdtrc as _pdtrc, gammaln as _gammaln, xlogy as _xlogy, \
+    hyperu as _hyperu, hyp2f1 as _hyp2f1, gammainccinv as _gammainccinv, betaincinv as _betaincinv
 import numpy as np
 
 from gamma_limits_sensitivity import li_ma_significance
 
-# This is the smallest number we can process within the numerical precision available
+# The smallest normal float. Smaller (subnormal) pvalues still give finite significances.
 tiny = np.finfo(float).tiny
 
-def significance_from_pvalue(pvalue):
+# Coefficients of the rational approximations used by the Cephes ndtri routine
+# (scipy/special/cephes/ndtri.c), highest order first.
+# Central region, |y - 0.5| <= 0.5 - exp(-2):
+_NDTRI_P0 = (
+    -5.99633501014107895267E1,
+    9.80010754185999661536E1,
+    -5.66762857469070293439E1,
+    1.39312609387279679503E1,
+    -1.23916583867381258016E0,
+)
+_NDTRI_Q0 = (
+    1.0,
+    1.95448858338141759834E0,
+    4.67627912898881538453E0,
+    8.63602421390890590575E1,
+    -2.25462687854119370527E2,
+    2.00260212380060660359E2,
+    -8.20372256168333339912E1,
+    1.59056225126211695515E1,
+    -1.18331621121330003142E0,
+)
+# Tails, for z = sqrt(-2 log y) between 2 and 8:
+_NDTRI_P1 = (
+    4.05544892305962419923E0,
+    3.15251094599893866154E1,
+    5.71628192246421288162E1,
+    4.40805073893200834700E1,
+    1.46849561928858024014E1,
+    2.18663306850790267539E0,
+    -1.40256079171354495875E-1,
+    -3.50424626827848203418E-2,
+    -8.57456785154685413611E-4,
+)
+_NDTRI_Q1 = (
+    1.0,
+    1.57799883256466749731E1,
+    4.53907635128879210584E1,
+    4.13172038254672030440E1,
+    1.50425385692907503408E1,
+    2.50464946208309415979E0,
+    -1.42182922854787788574E-1,
+    -3.80806407691578277194E-2,
+    -9.33259480895457427372E-4,
+)
+# Far tails, for z = sqrt(-2 log y) between 8 and 64:
+_NDTRI_P2 = (
+    3.23774891776946035970E0,
+    6.91522889068984211695E0,
+    3.93881025292474443415E0,
+    1.33303460815807542389E0,
+    2.01485389549179081538E-1,
+    1.23716634817820021358E-2,
+    3.01581553508235416007E-4,
+    2.65806974686737550832E-6,
+    6.23974539184983293730E-9,
+)
+_NDTRI_Q2 = (
+    1.0,
+    6.02427039364742014255E0,
+    3.67983563856160859403E0,
+    1.37702099489081330271E0,
+    2.16236993594496635890E-1,
+    1.34204006088543189037E-2,
+    3.28014464682127739104E-4,
+    2.89247864745380683936E-6,
+    6.79019408009981274425E-9,
+)
+_EXP_M2 = math.exp(-2)
+_SQRT_2PI = math.sqrt(2 * math.pi)
+_SQRT_HALF = math.sqrt(0.5)
+
+def _horner(x, coefficients):
+    """Evaluate the polynomial with the given coefficients (highest order first) at x."""
+    ans = 0.0
+    for c in coefficients:
+        ans = ans * x + c
+    return ans
+
+def _ndtri_scalar(y):
+    """
+    Inverse of the standard normal CDF for a single float, following Cephes ndtri.
+
+    :param y: probability
+    :return: x such that ndtr(x) = y
+    """
+    if not 0.0 < y < 1.0:
+        if y == 0.0:
+            return -math.inf
+        if y == 1.0:
+            return math.inf
+        return math.nan
+
+    negate = True
+    if y > 1.0 - _EXP_M2:
+        y = 1.0 - y
+        negate = False
+
+    if y > _EXP_M2:
+        y = y - 0.5
+        y2 = y * y
+        x = y + y * (y2 * _horner(y2, _NDTRI_P0) / _horner(y2, _NDTRI_Q0))
+        return x * _SQRT_2PI
+
+    x = math.sqrt(-2.0 * math.log(y))
+    x0 = x - math.log(x) / x
+    z = 1.0 / x
+    if x < 8.0:
+        x1 = z * _horner(z, _NDTRI_P1) / _horner(z, _NDTRI_Q1)
+    else:
+        x1 = z * _horner(z, _NDTRI_P2) / _horner(z, _NDTRI_Q2)
+    x = x0 - x1
+    return -x if negate else x
+
+def significance_from_pvalue(pvalue, dtype=float):
     """
     Return the significance (i.e., the z-score) for a given probability, i.e., the number of standard deviations (sigma)
     corresponding to the probability
 
     :param pvalue: input probability
+    :param dtype: floating point type of the result. np.float32 halves the memory
+        of large significance maps, at single precision.
     :return: z-score (or significance in units of sigma)
     """
 
-    # Make sure that we can compute this score (i.e., the pvalue is not too small)
-    if np.any(pvalue <= tiny):
-        raise ArithmeticError("One or more pvalues are too small for a significance computation.")
-
-    # This is equivalent to sqrt(2) * erfinv(1 - 2 * pvalue) but faster
-    return -scipy.special.ndtri(pvalue)
+    if dtype is float and isinstance(pvalue, float):
+        # scalar fast path, avoids the ufunc dispatch
+        zscore = -_ndtri_scalar(pvalue)
+        # pvalues of zero give infinite scores, values outside [0, 1] give nan
+        if not zscore < math.inf:
+            raise ArithmeticError("One or more pvalues are too small (or invalid) for a significance computation.")
+        # same return type as the array path
+        return np.float64(zscore)
+
+    if dtype is not float:
+        pvalue = np.asarray(pvalue, dtype=dtype)
+
+    # This is equivalent to sqrt(2) * erfinv(1 - 2 * pvalue) but faster.
+    # The negation is done in place, on the buffer returned by ndtri.
+    zscore = _ndtri(pvalue)
+    if isinstance(zscore, np.ndarray):
+        np.negative(zscore, out=zscore)
+    else:
+        zscore = -zscore
+
+    # Make sure that we could compute this score: pvalues of zero give
+    # infinite scores, values outside [0, 1] give nan. A pvalue of one gives -inf.
+    if not (zscore < np.inf).all():
+        raise ArithmeticError("One or more pvalues are too small (or invalid) for a significance computation.")
+    return zscore
 
 def pvalue_from_significance(zscore):
     """
@@ -61,7 +198,15 @@ def pvalue_from_significance(zscore):
     :param pvalue: z-score (or significance in units of sigma)
     :return: probability
     """
-    return scipy.special.ndtr(-np.asarray(zscore))
+    if isinstance(zscore, (int, float)):
+        # scalar fast path, avoids the ufunc dispatch. Same return type as the array path.
+        return np.float64(0.5 * math.erfc(zscore * _SQRT_HALF))
+
+    # the negated copy is the only allocation; ndtr then works in place on it
+    pvalue = np.negative(zscore, dtype=float)
+    if isinstance(pvalue, np.ndarray):
+        return _ndtr(pvalue, out=pvalue)
+    return _ndtr(pvalue)
 
 def significance(n, b, alpha, k=0):
     """
@@ -87,11 +232,36 @@ def significance(n, b, alpha, k=0):
     :return: the significance (z score) for the measurement(s)
     """
 
+    return make_significance(alpha, k)(n, b)
+
+def make_significance(alpha, k=0):
+    """
+    Returns a function of (n, b) which computes the significance for fixed alpha and k.
+    Useful when scanning many measurements with the same setup, for example over an image::
+
+        # known exposure ratio and 10% systematic uncertainty
+        sig = make_significance(alpha=0.1, k=0.1)
+        sig(n=counts_image, b=background_image)
+
+    See `significance` for the meaning of the parameters.
+
+    :param alpha: ratio of the source observation efficiency and background observation efficiency
+    :param k: maximum fractional systematic uncertainty expected, or negative for none.
+    :return: function significance(n, b) returning the significance (z score) for the measurement(s)
+    """
+
     if k < 0:
-        return significance_from_pvalue(scipy.stats.poisson.sf(n, alpha * b))
+        def significance_fixed(n, b):
+            # same as scipy.stats.poisson.sf(n, alpha * b), without the distribution object overhead
+            return significance_from_pvalue(_pdtrc(n, np.multiply(alpha, b)))
+        return significance_fixed
+
+    alpha_k = alpha * (k + 1)
 
-    sign = np.where(n >= alpha * b, 1, -1)
-    return sign * li_ma_significance(n, b, alpha * (k + 1))
+    def significance_fixed(n, b):
+        # negative if fewer counts than expected were observed; n == alpha * b gives +0.0 and keeps the sign positive
+        return np.copysign(li_ma_significance(n, b, alpha_k), n - np.multiply(alpha, b))
+    return significance_fixed
 
 def posterior(rate, n, b, alpha, exposure=1.0):
     """
@@ -105,19 +275,64 @@ def posterior(rate, n, b, alpha, exposure=1.0):
         (either a float, or an array of the same shape of n)
     :return: the probability
 
+    The inputs are broadcast against each other. To evaluate the posteriors of many sources
+    on a common rate grid in one call, pass n and b as column vectors::
+
+        # shape (len(n), len(rate))
+        posterior(rate, n[:,None], b[:,None], alpha)
+
+    The terms independent of the rate (including hyp2f1) are then evaluated once per source.
+
     Knoetig2014, appendix C. A flat prior on the background rate is assumed.
     https://ui.adsabs.harvard.edu/abs/2014ApJ...790..106K/abstract
     """
 
     nexp = exposure * rate
-    t_1 = 1 + b + n
+    inv_alpha = 1.0 / alpha
+    one_plus_inv_alpha = 1.0 + inv_alpha
+    nb = n + b
+    t_1 = 1 + nb
     hb = 0.5 + b
     thb = 1.5 + b
-    return scipy.stats.poisson.pmf(n + b, nexp) * scipy.special.hyperu(hb, t_1, (1 + 1. / alpha) * nexp) / scipy.special.hyp2f1(hb, t_1, thb, -1/alpha) * scipy.special.gamma(thb)
+    # the terms that do not depend on the rate are combined first,
+    # so that the rate grid is only traversed once in log-space.
+    # Both hypergeometric functions are positive here.
+    lognorm = _gammaln(thb) - _gammaln(t_1) - np.log(_hyp2f1(hb, t_1, thb, -inv_alpha))
+    with np.errstate(divide='ignore'):
+        # log of the Poisson probability of n + b counts, times the Tricomi function
+        logp = _xlogy(nb, nexp) - nexp + np.log(_hyperu(hb, t_1, one_plus_inv_alpha * nexp))
+    return np.exp(logp + lognorm)
     #return sign * li_ma_significance(n, b, alpha * (k + 1))
 
 
-def uncertainties_rate(k, q=pvalue_from_significance([0, -1, +1]), exposure=1.0):
+# default quantiles: the median, lower and upper 1 sigma.
+# Shared and read-only, so that it can be recognised by identity.
+_SIGMAS = np.array([0, -1, +1])
+_ONE_SIGMA_QUANTILES = pvalue_from_significance(_SIGMAS)
+_ONE_SIGMA_QUANTILES.setflags(write=False)
+
+# error bars for the default quantiles are memoized for small counts
+_CACHE_SIZE = 64
+_rate_cache = dict(enumerate(_gammainccinv(np.arange(1, _CACHE_SIZE + 1).reshape((-1, 1)), _ONE_SIGMA_QUANTILES)))
+_fraction_cache = {}
+
+
+@functools.lru_cache(maxsize=4096)
+def _uncertainties_rate_scalar(k, q, exposure):
+    """uncertainties_rate for a single int k and float quantile q, memoized."""
+    assert 0 < q < 1, "Quantile must be between zero and one."
+    return _gammainccinv(k + 1, q) / exposure
+
+
+@functools.lru_cache(maxsize=4096)
+def _uncertainties_fraction_scalar(k, n, q):
+    """uncertainties_fraction for int k and n and a float quantile q, memoized."""
+    assert k <= n, "k must be smaller than n."
+    assert 0 < q < 1, "Quantile must be between zero and one."
+    return _betaincinv(k + 1, n + 1 - k, q)
+
+
+def uncertainties_rate(k, q=_ONE_SIGMA_QUANTILES, exposure=1.0):
     """
     Give error bars on the number of events, given k detections.
 
@@ -130,13 +345,21 @@ def uncertainties_rate(k, q=pvalue_from_significance([0, -1, +1]), exposure=1.0)
 
     See e.g., https://arxiv.org/abs/1012.0566
     """
-    assert isinstance(k, (int, np.integer)) or isinstance(k, np.ndarray) and k.dtype == int, "k must be integer"
-    assert np.all(q > 0), "Quantile must be between zero and one."
-    assert np.all(q < 1), "Quantile must be between zero and one."
-    return scipy.special.gammainccinv(k + 1, q) / exposure
+    if q is _ONE_SIGMA_QUANTILES and isinstance(k, (int, np.integer)) and k in _rate_cache:
+        return _rate_cache[k] / exposure
+    if isinstance(k, int) and isinstance(q, float) and isinstance(exposure, (int, float)):
+        return _uncertainties_rate_scalar(k, q, exposure)
+
+    k = np.asarray(k)
+    assert k.dtype.kind in 'iu', "k must be integer"
+    # widen small integer types, so that the +1 below cannot wrap around
+    k = k.astype(np.int64, copy=False)
+    q = np.asarray(q)
+    assert ((q > 0) & (q < 1)).all(), "Quantile must be between zero and one."
+    return _gammainccinv(k + 1, q) / exposure
 
 
-def uncertainties_fraction(k, n, q=pvalue_from_significance([0, -1, +1])):
+def uncertainties_fraction(k, n, q=_ONE_SIGMA_QUANTILES):
     """
     Give error bars on a fraction, given k positives out of n possible.
 
@@ -148,12 +371,26 @@ def uncertainties_fraction(k, n, q=pvalue_from_significance([0, -1, +1])):
 
     See e.g., https://arxiv.org/abs/1012.0566
     """
-    assert isinstance(k, (int, np.integer)) or isinstance(k, np.ndarray) and k.dtype == int, "k must be integer"
-    assert isinstance(n, (int, np.integer)) or isinstance(n, np.ndarray) and n.dtype == int, "n must be integer"
+    if q is _ONE_SIGMA_QUANTILES and isinstance(k, (int, np.integer)) and isinstance(n, (int, np.integer)) and 0 <= k <= n < _CACHE_SIZE:
+        key = (int(k), int(n))
+        if key not in _fraction_cache:
+            _fraction_cache[key] = _betaincinv(k + 1, n + 1 - k, q)
+        return _fraction_cache[key].copy()
+    if isinstance(k, int) and isinstance(n, int) and isinstance(q, float):
+        return _uncertainties_fraction_scalar(k, n, q)
+
+    k = np.asarray(k)
+    assert k.dtype.kind in 'iu', "k must be integer"
+    # widen small integer types, so that the +1 below cannot wrap around
+    k = k.astype(np.int64, copy=False)
+    n = np.asarray(n)
+    assert n.dtype.kind in 'iu', "n must be integer"
+    # widen small integer types, so that the +1 below cannot wrap around
+    n = n.astype(np.int64, copy=False)
     assert np.all(k<=n), "k must be smaller than n."
-    assert np.all(q > 0), "Quantile must be between zero and one."
-    assert np.all(q < 1), "Quantile must be between zero and one."
-    return scipy.special.betaincinv(k + 1, n + 1 - k, q)
+    q = np.asarray(q)
+    assert ((q > 0) & (q < 1)).all(), "Quantile must be between zero and one."
+    return _betaincinv(k + 1, n + 1 - k, q)
 
 
 if __name__ == '__main__':
@@ -164,4 +401,5 @@ if __name__ == '__main__':
     print('rate for no events:', uncertainties_rate(0))
     print('significance of five events when 0.01 expected:', significance(5, 10, 0.01, k=-1), significance(5, 10, 0.01), significance(5, 10, 0.01, k=0.1))
     rate = np.linspace(0.01, 10, 40)
-    print('likelihood:', np.vstack((rate, posterior(rate, 4, 0, 0.01))).transpose())
+    # column_stack builds the (rate, probability) table in a single contiguous allocation
+    print('likelihood:', np.column_stack((rate, posterior(rate, 4, 0, 0.01))))
@@ -1,10 +1,14 @@
 import numpy as np
+import pytest
 from numpy.testing import assert_array_equal, assert_array_almost_equal, assert_allclose
 
 from hypothesis import example, given, assume, strategies as st
 import hypothesis.extra.numpy
 
-from poissonregime import significance_from_pvalue, pvalue_from_significance, uncertainties_rate, uncertainties_fraction
+import scipy.special
+import scipy.stats
+
+from poissonregime import significance_from_pvalue, pvalue_from_significance, uncertainties_rate, uncertainties_fraction, significance, make_significance, posterior
 
 sigstrategy = st.floats(allow_nan=False, allow_infinity=False, min_value=-7, max_value=7)
 probstrategy = st.floats(allow_nan=False, allow_infinity=False, min_value=0, max_value=1)
@@ -32,6 +36,41 @@ def test_p(p):
 	print(s, p, o)
 	assert_allclose(o, p, atol=1e-5)
 
+@given(probstrategy)
+@example(0.5)
+@example(1e-300)
+@example(1 - 1e-16)
+def test_sig_scalar(p):
+	assume(p >= 1e-300)
+	assume(p < 1)
+	s = significance_from_pvalue(p)
+	assert isinstance(s, np.float64)
+	assert isinstance(pvalue_from_significance(s), np.float64)
+	assert_allclose(s, significance_from_pvalue(np.array([p]))[0], rtol=1e-14)
+	assert_allclose(pvalue_from_significance(s), pvalue_from_significance(np.array([s]))[0], rtol=1e-12)
+
+def test_sig_float32():
+	p = np.array([0.5, 0.01, 0.99, 1e-30])
+	s = significance_from_pvalue(p, dtype=np.float32)
+	assert s.dtype == np.float32
+	assert_allclose(s, significance_from_pvalue(p), atol=1e-5)
+
+def test_sig_invalid():
+	for p in [0.0, 1.5, np.array([0.5, 0.0]), np.array([0.5, -0.1]), np.array([np.nan])]:
+		with pytest.raises(ArithmeticError):
+			significance_from_pvalue(p)
+
+def test_significance():
+	n = np.array([0, 1, 5, 10, 30])
+	assert_allclose(significance(n, 10, 0.1, k=-1), significance_from_pvalue(scipy.stats.poisson.sf(n, 1.0)))
+	z = significance(n, 10, 0.1)
+	assert np.all(z[n >= 1] >= 0)
+	assert np.all(z[n < 1] <= 0)
+	assert np.all(significance(n, 10, 0.1, k=0.1) <= z)
+	# strong deficit: the Poisson tail probability is exactly one
+	assert significance(0, 1e5, 0.01, k=-1) == -np.inf
+	assert_array_equal(significance(np.array([0, 10]), 5000, 1.0, k=-1), [-np.inf, -np.inf])
+
 @given(st.one_of(countstrategy, hypothesis.extra.numpy.arrays(int, shape=hypothesis.extra.numpy.array_shapes(), elements=countstrategy)), probstrategy)
 @example(1, 0.5)
 @example(np.array([1]), 0.5)
@@ -76,3 +115,50 @@ def test_fraction(p):
     print('rate for no events:', uncertainties_rate(0))
     print('significance of five events when 0.01 expected:', significance(5, 10, 0.01, k=-1), significance(5, 10, 0.01), significance(5, 10, 0.01, k=0.1))
 """
+
+def test_make_significance():
+	n = np.array([0, 1, 5, 10, 30])
+	b = np.array([10, 20, 10, 50, 100])
+	for k in [-1, 0, 0.1]:
+		assert_allclose(make_significance(0.1, k)(n, b), significance(n, b, 0.1, k=k))
+
+def test_default_quantiles_cache():
+	q = pvalue_from_significance(np.array([0, -1, +1]))
+	for k in [0, 1, 10, 63, 64, 100]:
+		assert_allclose(uncertainties_rate(k), uncertainties_rate(k, q=q))
+		assert_allclose(uncertainties_rate(k, exposure=10.), uncertainties_rate(k, q=q, exposure=10.))
+		assert_allclose(uncertainties_fraction(k // 2, k), uncertainties_fraction(k // 2, k, q=q))
+	uncertainties_fraction(1, 10)[0] = -1
+	assert uncertainties_fraction(1, 10)[0] > 0
+
+def test_posterior():
+	rate = np.linspace(0, 20, 41)
+	for n, b, alpha in [(0, 0, 0.01), (4, 0, 0.01), (3, 7, 0.5), (20, 100, 0.1)]:
+		nexp = 2.0 * rate
+		t_1 = 1 + b + n
+		hb = 0.5 + b
+		thb = 1.5 + b
+		expected = scipy.stats.poisson.pmf(n + b, nexp) * scipy.special.hyperu(hb, t_1, (1 + 1. / alpha) * nexp) / scipy.special.hyp2f1(hb, t_1, thb, -1/alpha) * scipy.special.gamma(thb)
+		assert_allclose(posterior(rate, n, b, alpha, exposure=2.0), expected, rtol=1e-10)
+
+def test_posterior_grid():
+	rate = np.linspace(0.01, 20, 41)
+	n = np.array([0, 4, 3, 20])
+	b = np.array([0, 0, 7, 100])
+	grid = posterior(rate, n[:,None], b[:,None], 0.1)
+	assert grid.shape == (len(n), len(rate))
+	for i in range(len(n)):
+		assert_allclose(grid[i], posterior(rate, n[i], b[i], 0.1))
+
+def test_scalar_cache():
+	for k, n, q in [(0, 0, 0.5), (3, 10, 0.1), (100, 1000, 0.9)]:
+		assert_allclose(uncertainties_rate(k, q=q, exposure=2.0), uncertainties_rate(np.array([k]), q=q, exposure=2.0)[0])
+		assert_allclose(uncertainties_fraction(k, n, q=q), uncertainties_fraction(np.array([k]), np.array([n]), q=q)[0])
+		assert isinstance(uncertainties_rate(k, q=q), np.float64)
+		assert isinstance(uncertainties_fraction(k, n, q=q), np.float64)
+
+def test_small_integer_types():
+	k = np.array([255], dtype=np.uint8)
+	assert_allclose(uncertainties_rate(k, q=0.5), uncertainties_rate(np.array([255]), q=0.5))
+	assert_allclose(uncertainties_fraction(k, k, q=0.5), uncertainties_fraction(np.array([255]), np.array([255]), q=0.5))
+	assert np.all(np.isfinite(uncertainties_fraction(np.array([100], dtype=np.int8), np.array([127], dtype=np.int8), q=0.5)))